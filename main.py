@@ -1,17 +1,42 @@
+import asyncio
+import functools
+import itertools
+import logging
 import os
 import re
+import time
 import requests
 from datetime import datetime
-from telegram import Update
+from telegram import MessageEntity, Update
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
 
 # === CONFIG ===
 BOT_TOKEN = os.getenv("BOT_TOKEN")  # Set in Railway
 HGL_URL = "https://www.ssa.gov/employer/highgroup.txt"
 
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+logging.getLogger("httpx").setLevel(logging.WARNING)  # one INFO line per Bot API call otherwise
+log = logging.getLogger("ssn_bot")
+
+# === BOT IDENTITY (Cached once at startup) ===
+BOT_USERNAME = None
+BOT_MENTION = None
+
 # === CACHE FOR HIGH GROUP LIST (Updated every 6 hours) ===
 hgl_cache = {}
-hgl_last_update = None
+hgl_last_update = None  # time.monotonic() of the last successful refresh
+hgl_retry_at = 0.0      # after a failed refresh, no new attempt before this time.monotonic()
+HGL_RETRY_DELAY = 60    # seconds
+_SESSION = requests.Session()  # keep-alive connection to ssa.gov across refreshes
+_hgl_lock = asyncio.Lock()
+_hgl_etag = None     # validators from the last full download, for conditional GETs
+_hgl_lastmod = None
+
+# === PRECOMPILED PATTERNS ===
+_NON_DIGIT_RE = re.compile(r'\D')
+_WS_RE = re.compile(r'\s+')
+# 9 ASCII digits passing every basic rule: area not 000/666/9xx, serial not 0000
+_SSN_RE = re.compile(r'(?!000|666|9)\d{3}\d{2}(?!0000)\d{4}', re.ASCII)
 
 # === STATE-AREA RANGES (Pre-2011) ===
 STATE_AREA_RANGES = {
@@ -26,59 +51,105 @@ STATE_AREA_RANGES = {
     "PR": [(580,584),(596,599)],"VI": [(580,584)],"GU": [(586,586)],"AS": [(586,586)],"MP": [(586,586)],"RR": [(700,728)]
 }
 
+def _pack(ranges):
+    bits = 0
+    for lo, hi in ranges:
+        bits |= ((1 << (hi - lo + 1)) - 1) << lo
+    return bits
+
+# Bit N of each mask is set iff area N falls in one of that state's ranges.
+# Frozen (state, mask) pairs: only ever iterated, never looked up by key.
+_STATE_BITMAPS = tuple((state, _pack(ranges)) for state, ranges in STATE_AREA_RANGES.items())
+
 # === FETCH HIGH GROUP LIST ===
-def get_hgl():
-    global hgl_cache, hgl_last_update
-    now = datetime.now()
-    if hgl_last_update is None or (now - hgl_last_update).total_seconds() > 21600:  # 6 hours
-        try:
-            r = requests.get(HGL_URL, timeout=10)
-            r.raise_for_status()
-            hgl = {}
-            for line in r.text.splitlines()[2:]:
-                parts = re.split(r'\s+', line.strip())
-                if len(parts) >= 2:
-                    area = parts[0].zfill(3)
-                    group = int(parts[1])
-                    hgl[area] = group
-            hgl_cache = hgl
-            hgl_last_update = now
-        except:
-            pass
+def hgl_stale(now):
+    if now < hgl_retry_at:
+        return False
+    return hgl_last_update is None or now - hgl_last_update > 21600  # 6 hours
+
+def fetch_hgl():
+    # Blocking download + parse; run off the event loop. Returns None if unchanged (304).
+    global _hgl_etag, _hgl_lastmod
+    headers = {}
+    if _hgl_etag:
+        headers['If-None-Match'] = _hgl_etag
+    if _hgl_lastmod:
+        headers['If-Modified-Since'] = _hgl_lastmod
+    hgl = {}
+    with _SESSION.get(HGL_URL, timeout=10, stream=True, headers=headers) as r:
+        if r.status_code == 304:
+            return None
+        r.raise_for_status()
+        # Parse lines as they arrive instead of buffering the whole body
+        for raw in itertools.islice(r.iter_lines(), 2, None):
+            parts = _WS_RE.split(raw.decode('ascii', 'ignore').strip())
+            if len(parts) >= 2:
+                area = int(parts[0])
+                group = int(parts[1])
+                hgl[area] = group
+        _hgl_etag = r.headers.get('ETag')
+        _hgl_lastmod = r.headers.get('Last-Modified')
+    return hgl
+
+async def get_hgl():
+    global hgl_cache, hgl_last_update, hgl_retry_at
+    if not hgl_stale(time.monotonic()):
+        return hgl_cache
+    # Only one refresh at a time; waiters reuse its result, including a failed attempt
+    async with _hgl_lock:
+        now = time.monotonic()
+        if hgl_stale(now):
+            try:
+                hgl = await asyncio.to_thread(fetch_hgl)
+                if hgl is not None:
+                    hgl_cache = hgl
+                hgl_last_update = now
+            except Exception as e:
+                hgl_retry_at = time.monotonic() + HGL_RETRY_DELAY
+                log.warning("High Group List refresh failed, retrying in %ds: %s", HGL_RETRY_DELAY, e)
     return hgl_cache
 
-# === VALIDATE SSN ===
-def validate_ssn(ssn: str, dob: str = None):
-    s = re.sub(r'\D', '', ssn)
-    if len(s) != 9 or not s.isdigit():
-        return False, "Must be 9 digits", None, None
+# === PARSE DOB (MM/DD/YYYY) ===
+def parse_dob_year(dob: str):
+    # Accepts what strptime("%m/%d/%Y") does for a whitespace-free token (check() splits
+    # on whitespace), without going through _strptime's regex machinery
+    if not dob.isascii():  # str.isdigit() below would also accept e.g. Arabic-Indic digits
+        return None
+    parts = dob.split('/')
+    if len(parts) != 3:
+        return None
+    m, d, y = parts
+    if not (m.isdigit() and d.isdigit() and y.isdigit()) or len(m) > 2 or len(d) > 2 or len(y) != 4:
+        return None
+    try:
+        return datetime(int(y), int(m), int(d)).year
+    except ValueError:
+        return None
 
-    area_str = s[:3]
-    group = int(s[3:5])
-    area = int(area_str)
-
-    # Basic rules
-    if area == 0: return False, "Area cannot be 000", None, None
-    if area == 666: return False, "Area 666 not issued", None, None
-    if 900 <= area <= 999: return False, "Area 900–999 reserved", None, None
-    if int(s[5:]) == 0: return False, "Serial cannot be 0000", None, None
-
-    # High Group Check
-    hgl = get_hgl()
-    high_group_passed = True
-    high_group_reason = ""
-    if hgl and area_str in hgl and group > hgl[area_str]:
-        high_group_passed = False
-        high_group_reason = f"Group {group} > issued {hgl[area_str]}"
-
-    # Possible States
-    possible_states = []
-    for state, ranges in STATE_AREA_RANGES.items():
-        for lo, hi in ranges:
-            if lo <= area <= hi:
-                possible_states.append(state)
+# === VALIDATE SSN ===
+@functools.lru_cache(maxsize=4096)
+def check_ssn_rules(s: str, dob_year: int = None):
+    # Everything except the High Group check; pure, so repeat lookups are cached.
+    # Callers pass only 9-character strings and a parsed year, keeping keys small.
+    if not _SSN_RE.fullmatch(s):
+        # Rejected by the combined pattern (or non-ASCII digits): find the rule that applies
+        if len(s) != 9 or not s.isdigit():
+            return False, "Must be 9 digits", None, None, None, None
+        area, serial = int(s[:3]), int(s[5:])
+
+        # Basic rules
+        if area == 0: return False, "Area cannot be 000", None, None, None, None
+        if area == 666: return False, "Area 666 not issued", None, None, None, None
+        if 900 <= area <= 999: return False, "Area 900–999 reserved", None, None, None, None
+        if serial == 0: return False, "Serial cannot be 0000", None, None, None, None
+
+    area, rest = divmod(int(s), 1000000)
+    group, serial = divmod(rest, 10000)
+
+    # Possible States (tuple: the cached result is shared between callers)
+    possible_states = tuple(state for state, bits in _STATE_BITMAPS if (bits >> area) & 1)
     if not possible_states:
-        possible_states = ["Unknown"]
+        possible_states = ("Unknown",)
 
     # Rough year range (pre-2011 SSA rules)
     year_range = "1936–2011"
@@ -86,24 +157,42 @@ def validate_ssn(ssn: str, dob: str = None):
         year_range = "Pre-2011 Randomized"
 
     # Refine year if DOB given
-    if dob:
-        try:
-            dt = datetime.strptime(dob, "%m/%d/%Y")
-            year_range = f"Approximate DOB: {dt.year}"
-        except:
-            pass
+    if dob_year is not None:
+        year_range = f"Approximate DOB: {dob_year}"
 
-    return True, "Valid", possible_states, year_range if high_group_passed else high_group_reason
+    return True, "Valid", area, group, possible_states, year_range
+
+def validate_ssn(ssn: str, hgl: dict, dob: str = None):
+    # Fast path: plain 9-digit input needs no stripping
+    s = ssn if len(ssn) == 9 and ssn.isascii() and ssn.isdigit() else _NON_DIGIT_RE.sub('', ssn)
+    if len(s) != 9:  # never let arbitrary junk into the cache
+        return False, "Must be 9 digits", None, None
+    dob_year = parse_dob_year(dob) if dob else None
+    valid, reason, area, group, possible_states, year_range = check_ssn_rules(s, dob_year)
+    if not valid:
+        return False, reason, None, None
+
+    # High Group Check (kept outside the cache so refreshes apply immediately)
+    if hgl and area in hgl and group > hgl[area]:
+        return True, "Valid", possible_states, f"Group {group} > issued {hgl[area]}"
+
+    return True, "Valid", possible_states, year_range
 
 # === BOT COMMANDS ===
+async def cache_bot_identity(app: Application):
+    global BOT_USERNAME, BOT_MENTION
+    # app.bot.get_me() already ran during initialize(); reuse its result
+    BOT_USERNAME = app.bot.username
+    BOT_MENTION = f"@{BOT_USERNAME.lower()}"
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
         "SSN Checker Pro v2\n\n"
-        "Send SSN to check: `123456789`\n"
-        "Optional DOB for refinement: `123456789 10/11/1993`\n"
-        "Example: `494089675 01/15/1987`\n"
-        "Works in private & groups.",
-        parse_mode='Markdown'
+        "Send SSN to check: <code>123456789</code>\n"
+        "Optional DOB for refinement: <code>123456789 10/11/1993</code>\n"
+        "Example: <code>494089675 01/15/1987</code>\n"
+        "Works in private &amp; groups.",
+        parse_mode='HTML'
     )
 
 async def check(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -112,41 +201,55 @@ async def check(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # In group: require @botname
     if message.chat.type in ['group', 'supergroup']:
-        bot = await context.bot.get_me()
-        bot_name = f"@{bot.username.lower()}"
-        if not text.lower().startswith(bot_name):
+        low = text.lower()
+        # Mention must be the whole leading token, so "@mybot2" doesn't count as "@mybot"
+        if not low.startswith(BOT_MENTION) or low[len(BOT_MENTION):len(BOT_MENTION) + 1].strip():
             return
-        text = re.sub(f'@{bot.username}', '', text, count=1, flags=re.IGNORECASE).strip()
+        text = text[len(BOT_MENTION):].lstrip()
 
     if not text:
         await message.reply_text("Send SSN to check.")
         return
 
-    parts = text.split()
+    parts = text.split(None, 2)  # only the SSN and DOB tokens are used
     ssn_input = parts[0]
     dob_input = parts[1] if len(parts) > 1 else None
 
-    valid, reason, states, year_range = validate_ssn(ssn_input, dob_input)
+    hgl = await get_hgl()
+    valid, reason, states, year_range = validate_ssn(ssn_input, hgl, dob_input)
 
-    result = f"{'✅ VALID' if valid else '❌ INVALID'} `{ssn_input}`\n"
-    result += f"Possible States: {', '.join(states)}\n"
-    result += f"Estimated Year/DOB Info: {year_range}\n"
+    status = '✅ VALID' if valid else '❌ INVALID'
+    lines = [f"{status} {ssn_input}\n"]
+    if states:  # None for invalid input
+        lines.append(f"Possible States: {', '.join(states)}\n")
+        lines.append(f"Estimated Year/DOB Info: {year_range}\n")
     if reason != "Valid":
-        result += f"Note: {reason}"
+        lines.append(f"Note: {reason}")
 
-    await message.reply_text(result, parse_mode='Markdown')
+    # Plain text + explicit code entity: nothing for Telegram to parse, nothing to escape.
+    # Offsets are UTF-16 code units; the status prefix is all BMP, so len() matches.
+    code = MessageEntity(MessageEntity.CODE, len(status) + 1, len(ssn_input.encode('utf-16-le')) // 2)
+    await message.reply_text(''.join(lines), entities=[code])
 
 # === MAIN ===
 def main():
     if not BOT_TOKEN:
-        print("ERROR: BOT_TOKEN not set!")
+        log.error("BOT_TOKEN not set!")
         return
-    app = Application.builder().token(BOT_TOKEN).build()
+    app = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .post_init(cache_bot_identity)
+        .concurrent_updates(True)  # a slow reply to one chat doesn't hold up the others
+        .http_version("2")  # concurrent replies share one multiplexed TLS connection
+        .build()
+    )
     app.add_handler(CommandHandler("start", start))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, check))
 
-    print("SSN Checker Bot v2 is running...")
-    app.run_polling()
+    log.info("SSN Checker Bot v2 is running...")
+    # Handlers only read update.message; don't have Telegram send edits, callbacks, etc.
+    app.run_polling(allowed_updates=[Update.MESSAGE])
 
 if __name__ == "__main__":
     main()